@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""Benchmarks for the HeightOfTerrain pipeline.
+
+Generates synthetic SRTM tiles and a synthetic RAF-style flight in a
+temporary directory (no network needed) and times each stage on its own:
+bounds detection, tile planning, tile loading, lookup throughput, gap
+filling and the netCDF write. Startup is timed too: a fresh interpreter
+importing the module for its lookup functions, and `HeightOfTerrain --help`.
+Results are printed and can be written as
+JSON, and compared against a stored baseline:
+
+    python bench_HeightOfTerrain.py --output bench.json
+    python bench_HeightOfTerrain.py --baseline bench.json --threshold 0.25
+
+The comparison exits with status 1 if any stage got slower than the
+baseline by more than the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import datetime
+import numpy as np
+import netCDF4
+
+import importlib.machinery
+import importlib.util
+
+# Load the HeightOfTerrain script (no .py extension) the same way the tests do
+_test_dir = os.path.dirname(os.path.abspath(__file__))
+_script_path = os.path.join(os.path.dirname(_test_dir), "HeightOfTerrain")
+if 'HeightOfTerrain' in sys.modules:
+    hot = sys.modules['HeightOfTerrain']
+else:
+    _loader = importlib.machinery.SourceFileLoader("HeightOfTerrain", _script_path)
+    hot = importlib.util.module_from_spec(importlib.util.spec_from_loader(_loader.name, _loader))
+    sys.modules['HeightOfTerrain'] = hot
+    _loader.exec_module(hot)
+
+# 10 hours at 25 Hz
+DEFAULT_RECORDS = 10 * 3600 * 25
+# Land tiles of the synthetic database: a 3x4 degree block with one missing
+# (open ocean) tile that the track crosses
+TILE_LATS = range(39, 42)
+TILE_LONS = range(-107, -103)
+OCEAN_TILES = {(40, -105)}
+
+
+def make_tiles(root):
+    """Write synthetic 1201x1201 .hgt tiles with smooth terrain and a few voids."""
+    os.makedirs(root, exist_ok=True)
+    rng = np.random.default_rng(1)
+    y, x = np.mgrid[0:1201, 0:1201] / 1200.0
+    for lt in TILE_LATS:
+        for lg in TILE_LONS:
+            if (lt, lg) in OCEAN_TILES:
+                continue
+            height = 1500 + 800 * np.sin(2 * np.pi * (x + lg)) * np.cos(2 * np.pi * (y + lt))
+            height += rng.normal(0, 20, height.shape)
+            data = height.astype('>i2')
+            data[rng.random(data.shape) < 1e-4] = -32768
+            data.tofile(os.path.join(root, f"{hot._tile_name(lt, lg)}.hgt"))
+
+
+def make_flight(path, records):
+    """Write a synthetic flight with tile-crossing legs, over-ocean and position gaps."""
+    t = np.linspace(0, 1, records)
+    # Zig-zag legs across the tile block, including the ocean tile
+    lat = 39.2 + 2.6 * np.abs(np.sin(7 * np.pi * t))
+    lon = -106.8 + 3.6 * t
+    latc = lat.copy()
+    lonc = lon.copy()
+    gglat = lat.copy()
+    rng = np.random.default_rng(2)
+    for start in rng.integers(0, records - 500, 20):
+        latc[start:start + 200] = np.nan        # Falls back to GPS
+        gglat[start + 100:start + 300] = np.nan  # GPS also missing in part
+    with netCDF4.Dataset(path, 'w') as nc:
+        nc.createDimension('Time', records)
+        for name in ('Time', 'LATC', 'LONC', 'GGALT', 'GGLAT', 'GGLON'):
+            nc.createVariable(name, 'f4', ('Time',), fill_value=-32767.0)
+        nc['Time'][:] = np.arange(records)
+        nc['LATC'][:] = latc
+        nc['LONC'][:] = lonc
+        nc['GGLAT'][:] = gglat
+        nc['GGLON'][:] = lon
+        nc['GGALT'][:] = 3000 + 2000 * np.sin(3 * np.pi * t)
+
+
+def _best_time(fn, repeat, setup=None):
+    """Run fn repeat times (after setup, untimed) and return the fastest wall time."""
+    best = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Imports the script the same way as above, in a fresh interpreter
+_IMPORT_SNIPPET = (
+    "import importlib.machinery, importlib.util\n"
+    "loader = importlib.machinery.SourceFileLoader('HeightOfTerrain', {path!r})\n"
+    "module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))\n"
+    "loader.exec_module(module)\n"
+)
+
+
+def startup_times(repeat=3):
+    """Time a fresh interpreter importing the module, and running --help.
+
+    Returns:
+        dict: stage name -> {'seconds': ...}; interpreter start-up itself is
+              included, so compare against a bare "python -c pass" run
+    """
+    commands = {
+        'startup_python': [sys.executable, '-c', 'pass'],
+        'startup_import': [sys.executable, '-c', _IMPORT_SNIPPET.format(path=_script_path)],
+        'startup_help': [sys.executable, _script_path, '--help'],
+    }
+    return {name: {'seconds': _best_time(
+                lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL), repeat)}
+            for name, command in commands.items()}
+
+
+def run_benchmarks(records=DEFAULT_RECORDS, repeat=3, workdir=None, startup=True):
+    """Time each pipeline stage on synthetic data.
+
+    Args:
+        records: Number of records in the synthetic flight
+        repeat: Runs per stage; the fastest is reported
+        workdir: Directory for the synthetic data (default: a temporary one)
+        startup: Also time the module import and --help (see startup_times())
+
+    Returns:
+        dict: 'meta' (run details) and 'stages' (stage name -> {'seconds': ...,
+              and 'samples_per_second' for per-sample stages})
+    """
+    tmp = None
+    if workdir is None:
+        workdir = tmp = tempfile.mkdtemp(prefix="hot_bench_")
+    saved = (hot.TdbData, hot.TileBackend, hot.Interpolation)
+    try:
+        stages = startup_times(repeat) if startup else {}
+        tdb = os.path.join(workdir, "TerrainData")
+        make_tiles(tdb)
+        flight = os.path.join(workdir, "BENCHrf01.nc")
+        make_flight(flight, records)
+        hot.TdbData = tdb
+        hot.TileBackend = "memmap"
+        hot.Interpolation = "nearest"
+
+        with netCDF4.Dataset(flight) as nc:
+            lat, lon = hot._read_positions(nc, 0, records)
+
+        def per_sample(seconds):
+            return {'seconds': seconds, 'samples_per_second': records / seconds}
+
+        stages['bounds'] = {'seconds': _best_time(
+            lambda: hot.compute_flight_bounds(flight), repeat, setup=hot._extent_cache.clear)}
+        stages['plan'] = {'seconds': _best_time(
+            lambda: hot.plan_terrain_database(hot.plan_flight_tiles(flight)), repeat)}
+
+        def cold_cache():
+            hot._terrain_cache.clear()
+            hot._tile_indexes.clear()
+
+        names = [hot._tile_name(lt, lg) for lt in TILE_LATS for lg in TILE_LONS]
+        for backend in hot.TILE_BACKENDS:
+            hot.TileBackend = backend
+            stages[f'tile_load_{backend}'] = {'seconds': _best_time(
+                lambda: [hot._load_tile(name) for name in names], repeat, setup=cold_cache)}
+        hot.TileBackend = "memmap"
+
+        for method in hot.INTERPOLATION_METHODS:
+            hot._terrain_cache.clear()
+            hot.HeightOfTerrainArray(lat[:1000], lon[:1000], method)  # Warm the cache
+            stages[f'lookup_{method}'] = per_sample(_best_time(
+                lambda: hot.HeightOfTerrainArray(lat, lon, method), repeat))
+
+        heights = hot.HeightOfTerrainArray(lat, lon)
+        stages['gap_fill'] = per_sample(_best_time(lambda: hot.fill_terrain_gaps(heights), repeat))
+
+        copy = os.path.join(workdir, "BENCHrf01_copy.nc")
+        stages['netcdf_write'] = per_sample(_best_time(
+            lambda: hot.write_terrain_variables(copy), repeat,
+            setup=lambda: shutil.copy(flight, copy)))
+
+        return {
+            'meta': {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'records': records,
+                'repeat': repeat,
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'processor': platform.processor(),
+            },
+            'stages': stages,
+        }
+    finally:
+        hot.TdbData, hot.TileBackend, hot.Interpolation = saved
+        hot._terrain_cache.clear()
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def compare(results, baseline, threshold=0.25, min_delta=0.005):
+    """Compare stage timings against a baseline.
+
+    Args:
+        results: Output of run_benchmarks()
+        baseline: Earlier output of run_benchmarks() (e.g. loaded from JSON)
+        threshold: Allowed slowdown as a fraction (0.25 = 25% slower)
+        min_delta: Slowdowns smaller than this many seconds are timer noise
+
+    Returns:
+        list: One message per stage slower than the baseline by more than threshold
+    """
+    if results['meta'].get('records') != baseline['meta'].get('records'):
+        print("Warning: baseline was run with a different number of records")
+    regressions = []
+    for name, stage in results['stages'].items():
+        base = baseline['stages'].get(name)
+        if base is None:
+            continue
+        ratio = stage['seconds'] / base['seconds']
+        if ratio > 1 + threshold and stage['seconds'] - base['seconds'] > min_delta:
+            regressions.append(f"{name}: {stage['seconds']:.4f} s vs {base['seconds']:.4f} s "
+                               f"({(ratio - 1) * 100:.0f}% slower)")
+    return regressions
+
+
+def print_results(results, baseline=None):
+    print(f"{results['meta']['records']} records, best of {results['meta']['repeat']}")
+    for name, stage in results['stages'].items():
+        line = f"  {name:<20} {stage['seconds']:10.4f} s"
+        if 'samples_per_second' in stage:
+            line += f"  {stage['samples_per_second']:14,.0f} samples/s"
+        if baseline is not None and name in baseline['stages']:
+            line += f"  ({stage['seconds'] / baseline['stages'][name]['seconds']:.2f}x baseline)"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the HeightOfTerrain pipeline.')
+    parser.add_argument('--records', type=int, default=DEFAULT_RECORDS,
+                        help='Records in the synthetic flight (default: %(default)s, 10 h at 25 Hz)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs per stage; the fastest is reported (default: %(default)s)')
+    parser.add_argument('--workdir', default=None,
+                        help='Directory for the synthetic data (default: a temporary directory)')
+    parser.add_argument('--output', default=None, help='Write the results as JSON to this file')
+    parser.add_argument('--baseline', default=None, help='JSON results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown against the baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.records, args.repeat, args.workdir)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for message in regressions:
+            print(f"REGRESSION {message}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
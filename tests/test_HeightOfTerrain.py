@@ -9,6 +9,12 @@ from unittest import mock
 from hypothesis import given, strategies as st, assume, settings
 from hypothesis.extra.numpy import arrays
 import datetime
+import io
+import json
+import threading
+import time
+import zipfile
+import http.server
 import netCDF4
 
 # Import the module under test
@@ -30,10 +36,13 @@ loader.exec_module(HeightOfTerrain_module)
 
 datetoday = HeightOfTerrain_module.datetoday
 HeightOfTerrain = HeightOfTerrain_module.HeightOfTerrain
+HeightOfTerrainArray = HeightOfTerrain_module.HeightOfTerrainArray
 parse_args = HeightOfTerrain_module.parse_args
 get_flight_bounds = HeightOfTerrain_module.get_flight_bounds
 TdbData = HeightOfTerrain_module.TdbData
 _terrain_cache = HeightOfTerrain_module._terrain_cache
+TileIndex = HeightOfTerrain_module.TileIndex
+TileCache = HeightOfTerrain_module.TileCache
 
 
 class TestDatetoday:
@@ -265,6 +274,740 @@ class TestHeightOfTerrain:
         assert not np.isnan(result)
 
 
+def _reference_height(height, lat, lon):
+    """Original per-sample index math, used as the reference for the batch API."""
+    ix = int((lon - np.floor(lon) + 1/2400) * 1200)
+    iy = int((np.ceil(lat) - lat + 1/2400) * 1200)
+    if np.ceil(lat) == lat:
+        iy = 1200
+    return height[iy, ix]
+
+
+class TestHeightOfTerrainArray:
+    """Unit tests for the vectorized HeightOfTerrainArray function."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache_before_test(self):
+        """Clear the cache before each test to ensure test isolation."""
+        _terrain_cache.clear()
+        yield
+        _terrain_cache.clear()
+
+    @pytest.fixture
+    def gradient_terrain(self, tmp_path, monkeypatch):
+        """Two adjacent tiles with distinct, asymmetric gradients."""
+        terrain_dir = tmp_path / "TerrainData"
+        terrain_dir.mkdir()
+        rows, cols = np.mgrid[0:1201, 0:1201]
+        tiles = {}
+        for name, base in (("N40W105", 1000), ("N40W104", 3000)):
+            data = (base + 2 * rows - cols).astype('>i2')
+            data[0:5, 0:5] = -32768
+            data.tofile(terrain_dir / f"{name}.hgt")
+            height = data.astype(np.float32)
+            height[height == -32768] = np.nan
+            tiles[name] = height
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        return tiles
+
+    def test_matches_reference(self, gradient_terrain):
+        """Batch results match the original scalar index math sample by sample."""
+        rng = np.random.default_rng(42)
+        lats = rng.uniform(40.0, 41.0, 500)
+        lons = rng.uniform(-105.0, -103.0, 500)
+        lats[:3] = [40.0, 40.5, 40.999]  # integer latitude edge case and near-edge
+        result = HeightOfTerrainArray(lats, lons)
+        for lat, lon, got in zip(lats, lons, result):
+            tile = gradient_terrain["N40W105" if lon < -104 else "N40W104"]
+            expected = _reference_height(tile, lat, lon)
+            assert np.array_equal(got, expected, equal_nan=True)
+
+    def test_float32_matches_scalar(self, gradient_terrain):
+        """float32 input (as read from netCDF) gives the same answers as the scalar path."""
+        lats = np.linspace(40.0, 40.99, 200, dtype=np.float32)
+        lons = np.linspace(-104.99, -103.01, 200, dtype=np.float32)
+        result = HeightOfTerrainArray(lats, lons)
+        for lat, lon, got in zip(lats, lons, result):
+            tile = gradient_terrain["N40W105" if lon < -104 else "N40W104"]
+            assert np.array_equal(got, _reference_height(tile, lat, lon), equal_nan=True)
+
+    def test_masked_nan_and_missing(self, gradient_terrain):
+        """Masked, NaN and missing-tile samples give NaN without affecting the rest."""
+        lats = ma.array([40.5, 40.5, np.nan, 10.5, 40.5], mask=[False, True, False, False, False])
+        lons = ma.array([-104.5, -104.5, -104.5, 10.5, np.nan])
+        result = HeightOfTerrainArray(lats, lons)
+        assert result.shape == (5,)
+        assert not np.isnan(result[0])
+        assert np.all(np.isnan(result[1:]))
+
+    def test_longitude_180_not_aliased(self, tmp_path, monkeypatch):
+        """Longitude 180 and off-globe longitudes do not pick up a tile of the next latitude row."""
+        np.full((1201, 1201), 777, dtype='>i2').tofile(tmp_path / "N11W180.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        result = HeightOfTerrainArray([10.5, 10.5, 11.5], [180.0, 200.0, -179.5])
+        assert np.isnan(result[0]) and np.isnan(result[1])
+        assert result[2] == 777
+
+    def test_void_cells(self, gradient_terrain):
+        """Void (-32768) cells come back as NaN."""
+        result = HeightOfTerrainArray([40.9999], [-104.9999])
+        assert np.isnan(result[0])
+
+    def test_empty_input(self):
+        """Empty input returns an empty array."""
+        assert HeightOfTerrainArray([], []).shape == (0,)
+
+
+_KERNELS = ["numpy", pytest.param("numba", marks=pytest.mark.skipif(
+    importlib.util.find_spec("numba") is None, reason="numba is not installed"))]
+
+
+class TestKernelBackends:
+    """Parity of the lookup kernels with the original scalar index math."""
+
+    # Tiles around the equator/prime meridian crossing and the antimeridian
+    TILES = [(lt, lg) for lt in (-1, 0) for lg in (-180, -1, 0, 179)]
+
+    @pytest.fixture
+    def world_terrain(self, tmp_path, monkeypatch):
+        terrain_dir = tmp_path / "TerrainData"
+        terrain_dir.mkdir()
+        rng = np.random.default_rng(21)
+        tiles = {}
+        for lt, lg in self.TILES:
+            data = rng.integers(-400, 4000, (1201, 1201)).astype('>i2')
+            data[rng.random(data.shape) < 0.01] = -32768
+            data.tofile(terrain_dir / f"{HeightOfTerrain_module._tile_name(lt, lg)}.hgt")
+            height = data.astype(np.float32)
+            height[height == -32768] = np.nan
+            tiles[lt, lg] = height
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        _terrain_cache.clear()
+        yield tiles
+        _terrain_cache.clear()
+
+    @staticmethod
+    def _samples(dtype):
+        rng = np.random.default_rng(22)
+        lats = rng.uniform(-1, 1, 3000)
+        lons = np.concatenate([rng.uniform(-180, -179, 1000), rng.uniform(-1, 1, 1000),
+                               rng.uniform(179, 180, 1000)])
+        # Exactly on seams and cell edges, in every hemisphere
+        edges_lat = [-1.0, -0.5, 0.0, 0.5, -1 + 0.5 / 1200, -0.5 / 1200, 0.5 / 1200, 1 - 1e-9]
+        edges_lon = [-180.0, -179.5, -1.0, -0.5 / 1200, 0.0, 0.5 / 1200, 179.0, 180 - 1e-9]
+        grid_lat, grid_lon = np.meshgrid(edges_lat, edges_lon)
+        return (np.append(lats, grid_lat.ravel()).astype(dtype),
+                np.append(lons, grid_lon.ravel()).astype(dtype))
+
+    @pytest.mark.parametrize("kernel", _KERNELS)
+    @pytest.mark.parametrize("dtype", [np.float32, np.float64])
+    def test_matches_reference(self, world_terrain, monkeypatch, kernel, dtype):
+        """Every kernel gives the scalar function's result, bit for bit."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', kernel)
+        lats, lons = self._samples(dtype)
+        result = HeightOfTerrainArray(lats, lons)
+        expected = []
+        for lat, lon in zip(lats, lons):
+            tile = world_terrain.get((int(np.floor(lat)), int(np.floor(lon))))
+            expected.append(np.nan if tile is None else _reference_height(tile, lat, lon))
+        assert np.array_equal(result, expected, equal_nan=True)
+
+    @pytest.mark.parametrize("kernel", _KERNELS[1:])
+    def test_kernel_parity(self, monkeypatch, kernel):
+        """The index arrays themselves are identical to the numpy kernel's, for any tile size."""
+        rng = np.random.default_rng(23)
+        for dtype in (np.float32, np.float64):
+            lats = rng.uniform(-90, 90, 20000).astype(dtype)
+            lons = rng.uniform(-180, 180, 20000).astype(dtype)
+            lats[:500] = np.round(lats[:500])
+            for last in (1200, 3600):
+                monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', "numpy")
+                expected = HeightOfTerrain_module._nearest_cells(lats, lons, last)
+                monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', kernel)
+                result = HeightOfTerrain_module._nearest_cells(lats, lons, last)
+                for got, want in zip(result, expected):
+                    assert got.dtype == want.dtype
+                    assert np.array_equal(got, want)
+
+    def test_numba_missing_falls_back(self, world_terrain, monkeypatch, capsys):
+        monkeypatch.setitem(sys.modules, 'numba', None)
+        monkeypatch.setattr(HeightOfTerrain_module, '_numba_kernels', {})
+        monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', "numba")
+        lats, lons = self._samples(np.float64)
+        result = HeightOfTerrainArray(lats, lons)
+        assert "numba is not installed" in capsys.readouterr().out
+        monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', "numpy")
+        assert np.array_equal(result, HeightOfTerrainArray(lats, lons), equal_nan=True)
+
+    def test_kernel_option(self, monkeypatch):
+        monkeypatch.setattr(HeightOfTerrain_module, 'KernelBackend', "numba")
+        with mock.patch('sys.argv', ['HeightOfTerrain']):
+            assert parse_args().kernel == "numba"
+        with mock.patch('sys.argv', ['HeightOfTerrain', '--kernel', 'numpy']):
+            assert parse_args().kernel == "numpy"
+
+
+class TestInterpolation:
+    """Tests for the bilinear and bicubic interpolation modes."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache_before_test(self):
+        _terrain_cache.clear()
+        yield
+        _terrain_cache.clear()
+
+    @staticmethod
+    def plane(lat, lon):
+        """A planar terrain surface, exactly representable at every grid cell."""
+        return 2 * (lat - 38) * 1200 + (lon + 106) * 1200
+
+    @pytest.fixture
+    def plane_terrain(self, tmp_path, monkeypatch):
+        """3x3 tiles around N40W105 sampling one continuous plane."""
+        terrain_dir = tmp_path / "TerrainData"
+        terrain_dir.mkdir()
+        rows, cols = np.mgrid[0:1201, 0:1201]
+        for lt in (39, 40, 41):
+            for lg in (-106, -105, -104):
+                lat = lt + 1 - rows / 1200
+                lon = lg + cols / 1200
+                data = np.rint(self.plane(lat, lon)).astype('>i2')
+                name = HeightOfTerrain_module._tile_name(lt, lg)
+                data.tofile(terrain_dir / f"{name}.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        return terrain_dir
+
+    @pytest.mark.parametrize("method", ["bilinear", "bicubic"])
+    def test_reproduces_plane(self, plane_terrain, method):
+        """Both methods reproduce a plane exactly, including next to tile seams."""
+        rng = np.random.default_rng(7)
+        lats = np.concatenate([rng.uniform(40.0, 41.0, 500), [40.0, 40.0001, 40.9999, 40.5]])
+        lons = np.concatenate([rng.uniform(-105.0, -104.0, 500), [-104.5, -104.9999, -104.0001, -105.0]])
+        result = HeightOfTerrainArray(lats, lons, method=method)
+        assert np.allclose(result, self.plane(lats, lons), atol=1e-6)
+
+    def test_nearest_is_default(self, plane_terrain):
+        """The default method is the original nearest-cell lookup."""
+        lats = np.array([40.123456, 40.87654])
+        lons = np.array([-104.3333, -104.7777])
+        assert np.array_equal(HeightOfTerrainArray(lats, lons),
+                              HeightOfTerrainArray(lats, lons, method="nearest"))
+
+    def test_smoother_than_nearest(self, plane_terrain):
+        """Interpolated heights vary continuously between grid cells."""
+        lons = np.full(100, -104.5)
+        lats = np.linspace(40.5, 40.5 + 1 / 1200, 100)
+        nearest = HeightOfTerrainArray(lats, lons)
+        bilinear = HeightOfTerrainArray(lats, lons, method="bilinear")
+        assert len(np.unique(nearest)) == 2
+        assert len(np.unique(bilinear)) > 50
+
+    def test_voids(self, tmp_path, monkeypatch):
+        """Voids are left out of bilinear weights; bicubic falls back to bilinear."""
+        terrain_dir = tmp_path / "TerrainData"
+        terrain_dir.mkdir()
+        data = np.full((1201, 1201), 1000, dtype='>i2')
+        data[600, 600] = -32768
+        data.tofile(terrain_dir / "N40W105.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        lat = 41 - 600.5 / 1200
+        lon = -105 + 600.5 / 1200
+        for method in ("bilinear", "bicubic"):
+            assert HeightOfTerrainArray([lat], [lon], method=method)[0] == pytest.approx(1000)
+        # Exactly on the void cell nothing valid carries weight
+        assert np.isnan(HeightOfTerrainArray([41 - 0.5], [-104.5], method="bilinear")[0])
+
+    def test_unknown_method(self):
+        with pytest.raises(ValueError):
+            HeightOfTerrainArray([40.5], [-104.5], method="spline")
+
+
+class TestTileBackends:
+    """Tests for the memory-mapped and fully decoded tile backends."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache_before_test(self):
+        _terrain_cache.clear()
+        yield
+        _terrain_cache.clear()
+
+    @pytest.fixture
+    def terrain_dir(self, tmp_path, monkeypatch):
+        terrain_dir = tmp_path / "TerrainData"
+        terrain_dir.mkdir()
+        rows, cols = np.mgrid[0:1201, 0:1201]
+        data = (1000 + 2 * rows - cols).astype('>i2')
+        data[100:200, 100:200] = -32768
+        data.tofile(terrain_dir / "N40W105.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        return terrain_dir
+
+    def test_backends_agree(self, terrain_dir, monkeypatch):
+        """memmap and array backends return identical heights, voids included."""
+        rng = np.random.default_rng(1)
+        lats = rng.uniform(40.0, 41.0, 2000)
+        lons = rng.uniform(-105.0, -104.0, 2000)
+        results = {}
+        for backend in HeightOfTerrain_module.TILE_BACKENDS:
+            _terrain_cache.clear()
+            monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', backend)
+            results[backend] = HeightOfTerrainArray(lats, lons)
+        assert np.array_equal(results["memmap"], results["array"], equal_nan=True)
+        assert np.isnan(results["memmap"]).any()
+
+    def test_memmap_tile_is_not_decoded(self, terrain_dir, monkeypatch):
+        """The memmap backend keeps the int16 file mapped instead of a float32 copy."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', 'memmap')
+        HeightOfTerrain(40.5, -104.5)
+        tile = _terrain_cache["N40W105"]
+        assert isinstance(tile.data, np.memmap)
+        assert tile.data.dtype == np.dtype('>i2')
+        assert np.isnan(tile.gather(np.array([150]), np.array([150]))[0])
+
+
+class TestCompactTiles:
+    """Tests for the chunked, compressed .hgc tile format."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache_before_test(self):
+        _terrain_cache.clear()
+        yield
+        _terrain_cache.clear()
+
+    @pytest.fixture
+    def hgt_tree(self, tmp_path):
+        terrain_dir = tmp_path / "TerrainData"
+        (terrain_dir / "J13").mkdir(parents=True)
+        rows, cols = np.mgrid[0:1201, 0:1201]
+        data = (2000 + 500 * np.sin(cols / 40.0) * np.cos(rows / 60.0)).astype('>i2')
+        data[0:300, 0:20] = -32768
+        data.tofile(terrain_dir / "J13" / "N40W105.hgt")
+        return terrain_dir, data
+
+    def test_round_trip(self, hgt_tree):
+        """Every sample, voids included, survives conversion."""
+        terrain_dir, data = hgt_tree
+        src = terrain_dir / "J13" / "N40W105.hgt"
+        dst = terrain_dir / "J13" / "N40W105.hgc"
+        size = HeightOfTerrain_module.write_compact_tile(str(src), str(dst))
+        assert size == dst.stat().st_size < src.stat().st_size / 2
+        tile = HeightOfTerrain_module.CompactTile("N40W105", str(dst))
+        iy, ix = np.mgrid[0:1201, 0:1201]
+        expected = data.astype(np.float32)
+        expected[expected == -32768] = np.nan
+        assert np.array_equal(tile.gather(iy.ravel(), ix.ravel()),
+                              expected.ravel(), equal_nan=True)
+
+    def test_only_touched_chunks_are_decoded(self, hgt_tree):
+        """A single-sample query decompresses a single chunk."""
+        terrain_dir, _ = hgt_tree
+        dst = terrain_dir / "N40W105.hgc"
+        HeightOfTerrain_module.write_compact_tile(str(terrain_dir / "J13" / "N40W105.hgt"), str(dst))
+        tile = HeightOfTerrain_module.CompactTile("N40W105", str(dst))
+        tile.gather(np.array([600]), np.array([600]))
+        assert tile._decoded.sum() == 1
+
+    def test_converted_tree_is_used_by_lookup(self, hgt_tree, monkeypatch):
+        """Lookups on a converted database match the .hgt results."""
+        terrain_dir, _ = hgt_tree
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        rng = np.random.default_rng(3)
+        lats = rng.uniform(40.0, 41.0, 1000)
+        lons = rng.uniform(-105.0, -104.0, 1000)
+        expected = HeightOfTerrainArray(lats, lons)
+
+        count, _, _ = HeightOfTerrain_module.convert_hgt_tree(str(terrain_dir), remove_source=True)
+        assert count == 1
+        assert not (terrain_dir / "J13" / "N40W105.hgt").exists()
+        HeightOfTerrain_module._get_tile_index().refresh(force=True)
+        _terrain_cache.clear()
+        assert np.array_equal(HeightOfTerrainArray(lats, lons), expected, equal_nan=True)
+        assert isinstance(_terrain_cache["N40W105"], HeightOfTerrain_module.CompactTile)
+
+
+class TestTileSources:
+    """Tests for 1-arc-second tiles and choosing the tile source per run."""
+
+    @pytest.fixture(autouse=True)
+    def srtm1_db(self, tmp_path, monkeypatch):
+        """A database with 1-arc-second tiles N40W105 and N40W104 that are linear in longitude."""
+        terrain_dir = tmp_path / "TerrainData"
+        (terrain_dir / "SRTM1").mkdir(parents=True)
+        rows, cols = np.mgrid[0:3601, 0:3601]
+        for lg in (-105, -104):
+            # Continuous across the seam: column 3600 of one tile is column 0 of the next
+            data = ((lg + 106) * 3600 + cols - rows // 4).astype('>i2')
+            data.tofile(terrain_dir / "SRTM1" / f"{HeightOfTerrain_module._tile_name(40, lg)}.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileSource', "srtm1")
+        _terrain_cache.clear()
+        yield terrain_dir
+        _terrain_cache.clear()
+
+    @staticmethod
+    def _expected(lat, lon):
+        """Nearest-cell reference with the 1-arc-second index math."""
+        lg = np.floor(lon)
+        ix = int((lon - lg + 1/7200) * 3600)
+        iy = 3600 if np.ceil(lat) == lat else int((np.ceil(lat) - lat + 1/7200) * 3600)
+        return (lg + 106) * 3600 + ix - iy // 4
+
+    def test_nearest_index_math(self):
+        rng = np.random.default_rng(11)
+        lats = np.append(rng.uniform(40.0, 41.0, 500), [40.0, 40.5])
+        lons = np.append(rng.uniform(-105.0, -103.0, 500), [-104.0, -104.0 + 0.5 / 3600])
+        result = HeightOfTerrainArray(lats, lons)
+        np.testing.assert_array_equal(result, [self._expected(lat, lon) for lat, lon in zip(lats, lons)])
+        assert _terrain_cache["N40W105"].size == 3601
+
+    @pytest.mark.parametrize("backend", ["memmap", "array", "compact"])
+    def test_bilinear_across_seam(self, srtm1_db, monkeypatch, backend):
+        """Interpolation uses 1-arc-second cells, including across the seam between tiles."""
+        if backend == "compact":
+            HeightOfTerrain_module.convert_hgt_tree(str(srtm1_db / "SRTM1"), remove_source=True)
+        else:
+            monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', backend)
+        lons = np.linspace(-104.0 - 2 / 3600, -104.0 + 2 / 3600, 41)
+        lats = np.full(lons.shape, 41 - 400 / 3600)  # Row 400 exactly
+        result = HeightOfTerrainArray(lats, lons, "bilinear")
+        np.testing.assert_allclose(result, (lons + 106) * 3600 - 100, atol=1e-6)
+
+    def test_sources_coexist(self, srtm1_db, monkeypatch):
+        """3- and 1-arc-second tiles of the same name are kept apart and chosen per run."""
+        np.full((1201, 1201), 7, dtype='>i2').tofile(srtm1_db / "N40W105.hgt")
+        assert HeightOfTerrain(40.5, -104.5) == self._expected(40.5, -104.5)
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileSource', "srtm3")
+        _terrain_cache.clear()
+        assert HeightOfTerrain(40.5, -104.5) == 7
+        assert np.isnan(HeightOfTerrain(40.5, -103.5))  # Only a 1-arc-second tile exists
+
+    def test_wrong_grid_size_rejected(self, srtm1_db, capsys):
+        np.full((1201, 1201), 7, dtype='>i2').tofile(srtm1_db / "SRTM1" / "N41W105.hgt")
+        assert np.isnan(HeightOfTerrain(41.5, -104.5))
+        assert "expected 3601x3601 for srtm1 tiles" in capsys.readouterr().out
+
+
+class TestTileCache:
+    """Unit tests for the bounded LRU tile cache."""
+
+    class FakeTile:
+        def __init__(self, nbytes):
+            self.nbytes = nbytes
+
+    def test_lru_eviction_by_bytes(self):
+        """The least recently used tile is evicted when the byte budget is exceeded."""
+        cache = TileCache(max_bytes=300)
+        for name in ("A", "B", "C"):
+            cache.put(name, self.FakeTile(100))
+        assert cache.get("A") is not None  # A is now most recently used
+        cache.put("D", self.FakeTile(100))
+        assert "B" not in cache
+        assert all(name in cache for name in ("A", "C", "D"))
+        assert cache.bytes == 300
+        assert cache.evictions == 1
+
+    def test_tile_count_budget(self):
+        """A tile-count budget limits the number of resident tiles."""
+        cache = TileCache(max_bytes=None, max_tiles=2)
+        for name in ("A", "B", "C"):
+            cache.put(name, self.FakeTile(10))
+        assert len(cache) == 2
+        assert "A" not in cache
+
+    def test_oversized_tile_is_kept(self):
+        """A single tile larger than the budget is still cached."""
+        cache = TileCache(max_bytes=10)
+        cache.put("A", self.FakeTile(100))
+        assert "A" in cache
+
+    def test_stats_and_clear(self):
+        """Hits, misses and load time are counted; clear() drops the tiles."""
+        cache = TileCache()
+        assert cache.get("A") is None
+        cache.put("A", self.FakeTile(50), load_time=0.25)
+        cache.get("A")
+        stats = cache.stats()
+        assert stats == {'tiles': 1, 'bytes': 50, 'hits': 1, 'misses': 1,
+                         'evictions': 0, 'load_time': 0.25}
+        cache.clear()
+        assert len(cache) == 0 and cache.bytes == 0
+
+    def test_resize_evicts(self):
+        """Shrinking the budget evicts down to it."""
+        cache = TileCache(max_bytes=None)
+        for name in ("A", "B", "C"):
+            cache.put(name, self.FakeTile(100))
+        cache.resize(max_bytes=150)
+        assert list(cache._tiles) == ["C"]
+
+
+class TestTileIndex:
+    """Unit tests for the persistent tile path index."""
+
+    @pytest.fixture
+    def terrain_dir(self, tmp_path):
+        terrain_dir = tmp_path / "TerrainData"
+        (terrain_dir / "J13").mkdir(parents=True)
+        np.full((1201, 1201), 1500, dtype='>i2').tofile(terrain_dir / "J13" / "N40W105.hgt")
+        return terrain_dir
+
+    def test_lookup_finds_nested_tiles(self, terrain_dir):
+        """Tiles in archive subfolders are found by name."""
+        index = TileIndex(str(terrain_dir))
+        assert index.lookup("N40W105") == str(terrain_dir / "J13" / "N40W105.hgt")
+        assert index.lookup("N41W105") is None
+
+    def test_missing_tile_is_negatively_cached(self, terrain_dir, monkeypatch, capsys):
+        """Repeated lookups of a missing tile do not walk the database again."""
+        index = TileIndex(str(terrain_dir))
+        index.refresh()
+        calls = []
+        real_walk = os.walk
+        monkeypatch.setattr(HeightOfTerrain_module.os, 'walk',
+                            lambda *a, **k: calls.append(a) or real_walk(*a, **k))
+        for _ in range(1000):
+            assert index.lookup("S60E150") is None
+        assert calls == []
+        assert capsys.readouterr().out.count("File not found: S60E150.hgt") == 1
+
+    def test_rebuilds_when_directory_changes(self, terrain_dir, monkeypatch):
+        """A tile added after a miss is picked up once the directory changes."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'TILE_INDEX_RECHECK', 0.0)
+        index = TileIndex(str(terrain_dir))
+        assert index.lookup("N41W105") is None
+        (terrain_dir / "K13").mkdir()
+        np.zeros((1201, 1201), dtype='>i2').tofile(terrain_dir / "K13" / "N41W105.hgt")
+        assert index.lookup("N41W105") == str(terrain_dir / "K13" / "N41W105.hgt")
+
+    def test_manifest_reused_by_later_runs(self, terrain_dir, monkeypatch):
+        """A second index on an unchanged database loads the manifest instead of scanning."""
+        TileIndex(str(terrain_dir)).refresh()
+        monkeypatch.setattr(TileIndex, 'scan', lambda self: pytest.fail("rescanned"))
+        index = TileIndex(str(terrain_dir))
+        assert index.lookup("N40W105") == str(terrain_dir / "J13" / "N40W105.hgt")
+
+    def test_nonexistent_database(self, tmp_path):
+        """A database directory that does not exist just has no tiles."""
+        index = TileIndex(str(tmp_path / "missing"))
+        assert index.lookup("N40W105") is None
+        assert not (tmp_path / "missing").exists()
+
+
+def _make_archive(name, tiles):
+    """Build an in-memory viewfinderpanoramas-style zip holding name/<tile>.hgt members."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for tile, value in tiles.items():
+            zf.writestr(f"{name}/{tile}.hgt", np.full((1201, 1201), value, dtype='>i2').tobytes())
+    return buf.getvalue()
+
+
+@pytest.fixture
+def archive_server():
+    """Local HTTP stand-in for the archive server, with Range support and a request log."""
+    files = {}
+    requests = []
+    cut_short = {}
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append((self.path, self.headers.get('Range')))
+            body = files.get(self.path.lstrip('/'))
+            if body is None:
+                self.send_error(404)
+                return
+            start = 0
+            if self.headers.get('Range'):
+                start = int(self.headers['Range'].split('=')[1].split('-')[0])
+                if start >= len(body):
+                    self.send_error(416)
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', f"bytes {start}-{len(body) - 1}/{len(body)}")
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(len(body) - start))
+            self.end_headers()
+            # Drop the connection after at most cut_short[name] bytes
+            self.wfile.write(body[start:][:cut_short.pop(self.path.lstrip('/'), None)])
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.files = files
+    server.requests = requests
+    server.cut_short = cut_short
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestArchiveDownload:
+    """Tests for the concurrent, resumable archive downloader."""
+
+    def test_archive_names(self):
+        """Archive naming matches the viewfinderpanoramas 4x6 degree blocks."""
+        archive_name = HeightOfTerrain_module.archive_name
+        assert archive_name(40, -105) == "K13"
+        assert archive_name(-43, 147) == "SK55"
+        # One archive covers many 1-degree cells
+        archives = HeightOfTerrain_module.archives_for_bounds(40, 43, -108, -103)
+        assert archives == ["K13"]
+        # Antimeridian-crossing boxes wrap around
+        archives = HeightOfTerrain_module.archives_for_bounds(-20, -19, 179, -179)
+        assert archives[0] == "SE60" and archives[-1] == "SE01"
+
+    def test_download_and_manifest(self, tmp_path, archive_server):
+        """Archives are fetched once, verified and skipped on the next run."""
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500})
+        archive_server.files["J13.zip"] = _make_archive("J13", {"N36W105": 1200})
+        results = HeightOfTerrain_module.download_archives(
+            ["K13", "J13", "K13", "Z99"], str(tmp_path), archive_server.url, workers=3)
+        assert results == {"K13": "downloaded", "J13": "downloaded", "Z99": "missing"}
+        assert zipfile.is_zipfile(tmp_path / "K13.zip")
+        assert not list(tmp_path.glob("*.part"))
+        manifest = json.loads((tmp_path / ".tile_index" / "archives.json").read_text())
+        assert manifest["K13"]["size"] == len(archive_server.files["K13.zip"])
+        assert len(manifest["K13"]["sha256"]) == 64
+
+        archive_server.requests.clear()
+        results = HeightOfTerrain_module.download_archives(
+            ["K13", "J13", "Z99"], str(tmp_path), archive_server.url)
+        assert results == {"K13": "verified", "J13": "verified", "Z99": "missing"}
+        assert archive_server.requests == []
+
+    def test_missing_is_kept_per_url(self, tmp_path, archive_server, monkeypatch):
+        """A 404 is only trusted for the URL that returned it, and only until it expires."""
+        wrong_url = f"{archive_server.url}/wrong"
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), wrong_url)
+        assert results == {"K13": "missing"}
+
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500})
+        archive_server.requests.clear()
+        assert HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), wrong_url) == {"K13": "missing"}
+        assert archive_server.requests == []
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        plan = HeightOfTerrain_module.plan_terrain_database({(40, -105)}, base_url=archive_server.url)
+        assert plan['archives'] == {"K13": ["N40W105"]}
+
+        monkeypatch.setattr(HeightOfTerrain_module, 'MISSING_ARCHIVE_TTL', 0)
+        archive_server.files["wrong/K13.zip"] = archive_server.files["K13.zip"]
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), wrong_url)
+        assert results == {"K13": "downloaded"}
+
+    def test_resume_partial_download(self, tmp_path, archive_server):
+        """An interrupted .part file is resumed with a Range request."""
+        body = _make_archive("K13", {"N40W105": 1500, "N41W105": 1600})
+        archive_server.files["K13.zip"] = body
+        (tmp_path / "K13.zip.part").write_bytes(body[:1000])
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), archive_server.url)
+        assert results == {"K13": "downloaded"}
+        assert archive_server.requests == [("/K13.zip", "bytes=1000-")]
+        assert (tmp_path / "K13.zip").read_bytes() == body
+
+    def test_short_download_is_resumed(self, tmp_path, archive_server):
+        """A body cut short by the server is kept as .part and resumed on the next run."""
+        body = _make_archive("K13", {"N40W105": 1500, "N41W105": 1600})
+        archive_server.files["K13.zip"] = body
+        archive_server.cut_short["K13.zip"] = 1000
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), archive_server.url)
+        assert results == {"K13": "failed"}
+        assert (tmp_path / "K13.zip.part").read_bytes() == body[:1000]
+        assert not (tmp_path / "K13.zip").exists()
+
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), archive_server.url)
+        assert results == {"K13": "downloaded"}
+        assert archive_server.requests[-1] == ("/K13.zip", "bytes=1000-")
+        assert (tmp_path / "K13.zip").read_bytes() == body
+
+    def test_corrupt_download_is_discarded(self, tmp_path, archive_server):
+        """A download that is not a valid zip is removed rather than kept."""
+        archive_server.files["K13.zip"] = b"not a zip file"
+        results = HeightOfTerrain_module.download_archives(["K13"], str(tmp_path), archive_server.url)
+        assert results == {"K13": "failed"}
+        assert not (tmp_path / "K13.zip").exists()
+        assert not (tmp_path / "K13.zip.part").exists()
+
+    def test_prepare_database(self, tmp_path, archive_server, monkeypatch):
+        """prepare_terrain_database downloads, extracts and indexes the tiles."""
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500})
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        _terrain_cache.clear()
+        HeightOfTerrain_module.prepare_terrain_database(["K13"], base_url=archive_server.url)
+        assert (tmp_path / "K13" / "N40W105.hgt").exists()
+        assert HeightOfTerrain(40.5, -104.5) == 1500
+        _terrain_cache.clear()
+
+    def test_compact_converts_only_extracted_tiles(self, tmp_path, archive_server, monkeypatch):
+        """--compact converts the tiles it extracted and leaves other .hgt files alone."""
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500})
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        (tmp_path / "SRTM1").mkdir()
+        np.zeros((3601, 3601), dtype='>i2').tofile(tmp_path / "SRTM1" / "N40W105.hgt")
+        (tmp_path / "J13").mkdir()
+        np.zeros((1201, 1201), dtype='>i2').tofile(tmp_path / "J13" / "N36W105.hgt")
+        _terrain_cache.clear()
+        HeightOfTerrain_module.prepare_terrain_database(["K13"], base_url=archive_server.url,
+                                                        compact=True)
+        assert (tmp_path / "K13" / "N40W105.hgc").exists()
+        assert not (tmp_path / "K13" / "N40W105.hgt").exists()
+        assert (tmp_path / "SRTM1" / "N40W105.hgt").exists()
+        assert not (tmp_path / "SRTM1" / "N40W105.hgc").exists()
+        assert (tmp_path / "J13" / "N36W105.hgt").exists()
+        assert HeightOfTerrain(40.5, -104.5) == 1500
+        _terrain_cache.clear()
+
+
+class TestZipMemberTiles:
+    """Tests for reading tiles straight out of unextracted zip archives."""
+
+    @pytest.fixture(autouse=True)
+    def clear_cache_before_test(self):
+        _terrain_cache.clear()
+        yield
+        _terrain_cache.clear()
+        HeightOfTerrain_module._zip_handles.close()
+
+    def test_lookup_from_archive(self, tmp_path, monkeypatch):
+        """Tiles inside a downloaded archive are found and read without extraction."""
+        (tmp_path / "K13.zip").write_bytes(_make_archive("K13", {"N40W105": 1500, "N41W105": 1700}))
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        result = HeightOfTerrainArray([40.5, 41.5, 42.5], [-104.5, -104.5, -104.5])
+        assert np.array_equal(result, [1500, 1700, np.nan], equal_nan=True)
+        assert isinstance(_terrain_cache["N40W105"], HeightOfTerrain_module.ZipMemberTile)
+        assert not (tmp_path / "K13").exists()
+
+    def test_extracted_tiles_preferred(self, tmp_path):
+        """An extracted .hgt file wins over the archive member of the same tile."""
+        (tmp_path / "K13.zip").write_bytes(_make_archive("K13", {"N40W105": 1500}))
+        (tmp_path / "K13").mkdir()
+        np.full((1201, 1201), 10, dtype='>i2').tofile(tmp_path / "K13" / "N40W105.hgt")
+        index = TileIndex(str(tmp_path))
+        assert index.lookup("N40W105") == str(tmp_path / "K13" / "N40W105.hgt")
+
+    def test_prepare_without_extraction(self, tmp_path, archive_server, monkeypatch):
+        """With ExtractArchives off, archives are downloaded but not unpacked."""
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500})
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        monkeypatch.setattr(HeightOfTerrain_module, 'ExtractArchives', False)
+        HeightOfTerrain_module.prepare_terrain_database(["K13"], base_url=archive_server.url)
+        assert not (tmp_path / "K13").exists()
+        assert HeightOfTerrain(40.5, -104.5) == 1500
+
+    def test_handle_pool_is_bounded(self, tmp_path):
+        """The handle pool keeps at most max_handles archives open."""
+        pool = HeightOfTerrain_module.ZipHandlePool(max_handles=2)
+        for name in ("A", "B", "C"):
+            (tmp_path / f"{name}.zip").write_bytes(_make_archive(name, {"N40W105": 1}))
+            pool.read(str(tmp_path / f"{name}.zip"), f"{name}/N40W105.hgt")
+        assert len(pool._handles) == 2
+        pool.close()
+
+
 class TestGetFlightBounds:
     """Unit tests for the get_flight_bounds function."""
 
@@ -384,6 +1127,74 @@ Maximum Longitude: -99.1"""
         assert lg_e == -98  # ceil(-99.1) + 1 = -99 + 1 = -98
 
 
+class TestComputeFlightBounds:
+    """Unit tests for the in-process flight bounds engine."""
+
+    @staticmethod
+    def make_flight(path, lats, lons, attrs=None, gps=None):
+        with netCDF4.Dataset(path, 'w') as nc:
+            nc.createDimension('Time', len(lats))
+            for name in ('Time', 'LATC', 'LONC', 'GGLAT', 'GGLON'):
+                nc.createVariable(name, 'f8', ('Time',))
+            nc['Time'][:] = np.arange(len(lats))
+            nc['LATC'][:] = lats
+            nc['LONC'][:] = lons
+            gglat, gglon = gps if gps is not None else (lats, lons)
+            nc['GGLAT'][:] = gglat
+            nc['GGLON'][:] = gglon
+            for name, value in (attrs or {}).items():
+                nc.setncattr(name, value)
+        return str(path)
+
+    def test_from_position_variables(self, tmp_path):
+        fname = self.make_flight(tmp_path / "a.nc", np.linspace(37.2, 41.5, 50),
+                                 np.linspace(-111.8, -99.1, 50))
+        assert HeightOfTerrain_module.compute_flight_bounds(fname) == (36, 43, -113, -98)
+
+    def test_gps_fallback_and_nan(self, tmp_path):
+        """NaN LATC/LONC samples use GGLAT/GGLON; NaN everywhere is ignored."""
+        lats = np.array([40.5, np.nan, np.nan, 40.6])
+        lons = np.array([-104.5, -104.4, np.nan, -104.3])
+        gps = (np.array([40.5, 45.5, np.nan, 40.6]), np.array([-104.5, -104.4, np.nan, -104.3]))
+        fname = self.make_flight(tmp_path / "a.nc", lats, lons, gps=gps)
+        assert HeightOfTerrain_module.compute_flight_bounds(fname) == (39, 47, -106, -103)
+
+    def test_from_global_attributes(self, tmp_path):
+        attrs = {'geospatial_lat_min': -61.997105, 'geospatial_lat_max': -42.40082,
+                 'geospatial_lon_min': 133.91486, 'geospatial_lon_max': 163.02815}
+        fname = self.make_flight(tmp_path / "a.nc", [0.0], [0.0], attrs=attrs)
+        assert HeightOfTerrain_module.compute_flight_bounds(fname) == (-63, -41, 132, 165)
+
+    def test_antimeridian(self, tmp_path):
+        """A track crossing 180 degrees gives lg_w > lg_e."""
+        lons = np.concatenate([np.linspace(178.2, 179.9, 20), np.linspace(-179.9, -178.5, 20)])
+        fname = self.make_flight(tmp_path / "a.nc", np.linspace(-20, -18, 40), lons)
+        assert HeightOfTerrain_module.compute_flight_bounds(fname) == (-21, -17, 177, -177)
+
+    def test_combines_flights_and_caches(self, tmp_path, monkeypatch):
+        a = self.make_flight(tmp_path / "a.nc", [40.5], [-104.5])
+        b = self.make_flight(tmp_path / "b.nc", [35.5], [-100.5])
+        assert HeightOfTerrain_module.compute_flight_bounds([a, b]) == (34, 42, -106, -99)
+        monkeypatch.setattr(netCDF4, 'Dataset',
+                            mock.Mock(side_effect=AssertionError("reopened")))
+        assert HeightOfTerrain_module.compute_flight_bounds([a, b]) == (34, 42, -106, -99)
+
+    def test_no_positions(self, tmp_path):
+        fname = self.make_flight(tmp_path / "a.nc", [np.nan], [np.nan])
+        assert HeightOfTerrain_module.compute_flight_bounds(fname) is None
+
+    def test_main_without_flt_area(self, flight_file, monkeypatch):
+        """main() finds the bounds itself when flt_area is not installed."""
+        monkeypatch.setattr('shutil.which', lambda x: None)
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(flight_file.parent), '--chunk-size', '0',
+                '--plan', 'box']
+        with mock.patch('sys.argv', argv), \
+                mock.patch.object(HeightOfTerrain_module, 'prepare_terrain_database') as prepare:
+            HeightOfTerrain_module.main()
+        archives = prepare.call_args[0][0]
+        assert archives == HeightOfTerrain_module.archives_for_bounds(39, 42, -106, -102)
+
+
 class TestParseArgs:
     """Unit tests for the parse_args function."""
 
@@ -399,6 +1210,13 @@ class TestParseArgs:
             assert args.lg_w is None  # Now defaults to None for auto-detection
             assert args.lg_e is None  # Now defaults to None for auto-detection
             assert args.Tdb == 'yes'
+            assert args.tile_backend == 'memmap'
+            assert args.cache_tiles is None
+            assert args.compact is False
+            assert args.interpolation == 'nearest'
+            assert args.chunk_size == HeightOfTerrain_module.CHUNK_RECORDS
+            assert args.terrain_max is None
+            assert args.prefetch == 0
 
     def test_parse_args_custom_values(self):
         """Test parsing custom command-line arguments."""
@@ -611,6 +1429,949 @@ class TestIntegration:
             assert actual_name == expected_name, \
                 f"For ({lat}, {lon}), expected {expected_name}, got {actual_name}"
 
+@pytest.fixture
+def flight_file(tmp_path, monkeypatch):
+    """A synthetic flight over two terrain tiles, with NaN gaps, masked samples and GPS fallback."""
+    terrain_dir = tmp_path / "TerrainData"
+    terrain_dir.mkdir()
+    rng = np.random.default_rng(5)
+    for name in ("N40W105", "N40W104"):
+        data = rng.integers(1000, 3000, (1201, 1201)).astype('>i2')
+        data[:100, :100] = -32768
+        data.tofile(terrain_dir / f"{name}.hgt")
+    monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(terrain_dir))
+    _terrain_cache.clear()
+
+    n = 5000
+    lat = np.linspace(40.01, 40.99, n).astype('f4')
+    lon = np.linspace(-104.99, -103.01, n).astype('f4')
+    nc_file = tmp_path / "TESTrf01.nc"
+    with netCDF4.Dataset(nc_file, 'w') as nc:
+        nc.createDimension('Time', n)
+        for name in ('Time', 'LATC', 'LONC', 'GGALT', 'GGLAT', 'GGLON'):
+            nc.createVariable(name, 'f4', ('Time',), fill_value=-32767.0)
+        latc, lonc = lat.copy(), lon.copy()
+        latc[100:150] = np.nan       # falls back to GPS
+        lonc[1000:1100] = np.nan     # falls back to GPS, GPS also missing in part
+        latc[2000:2010] = -32767.0   # masked
+        gglat = lat.copy()
+        gglat[1050:1060] = np.nan
+        ggalt = np.linspace(3000, 6000, n).astype('f4')
+        ggalt[3000:3020] = -32767.0  # masked altitude
+        nc['Time'][:] = np.arange(n)
+        nc['LATC'][:] = latc
+        nc['LONC'][:] = lonc
+        nc['GGLAT'][:] = gglat
+        nc['GGLON'][:] = lon
+        nc['GGALT'][:] = ggalt
+    yield nc_file
+    _terrain_cache.clear()
+
+
+def _read_outputs(nc_file):
+    with netCDF4.Dataset(nc_file) as nc:
+        return {name: (nc[name][:], nc[name].actual_range) for name in ('SFC_SRTM', 'ALTG_SRTM')}
+
+
+def _assert_same_outputs(a, b):
+    for name in ('SFC_SRTM', 'ALTG_SRTM'):
+        assert ma.allequal(a[name][0], b[name][0]), name
+        assert np.array_equal(ma.getmaskarray(a[name][0]), ma.getmaskarray(b[name][0])), name
+        assert a[name][1] == b[name][1], name
+
+
+class TestStreaming:
+    """Tests for block-wise processing of flight files."""
+
+    def test_fill_blockwise_matches_whole(self):
+        """Filling block by block with a one-sample carry-over equals filling at once."""
+        rng = np.random.default_rng(0)
+        raw = rng.uniform(0, 3000, 1000)
+        raw[rng.random(1000) < 0.1] = np.nan
+        raw[0:3] = [np.nan, 5.0, 6.0]
+        whole = HeightOfTerrain_module.fill_terrain_gaps(raw)
+        for size in (2, 3, 7, 100):
+            parts = []
+            prev = None
+            for start in range(0, len(raw), size):
+                block = raw[start:start + size]
+                parts.append(HeightOfTerrain_module.fill_terrain_gaps(block, prev))
+                prev = block[-1]
+            assert np.array_equal(np.concatenate(parts), whole)
+        assert not np.isnan(whole).any()
+
+    def test_chunked_matches_whole_file(self, flight_file, tmp_path):
+        """Every block size gives the same variables and actual_range."""
+        write = HeightOfTerrain_module.write_terrain_variables
+        write(str(flight_file), chunk_size=0)
+        reference = _read_outputs(flight_file)
+        for size in (2, 333, 4999):
+            copy = tmp_path / f"copy{size}.nc"
+            shutil.copy(flight_file, copy)
+            write(str(copy), chunk_size=size)
+            _assert_same_outputs(_read_outputs(copy), reference)
+
+    def test_outputs_written(self, flight_file):
+        """SFC_SRTM/ALTG_SRTM are created with their attributes."""
+        HeightOfTerrain_module.write_terrain_variables(str(flight_file), chunk_size=1000)
+        with netCDF4.Dataset(flight_file) as nc:
+            sfc = nc['SFC_SRTM'][:]
+            assert sfc.shape == (5000,)
+            assert 1000 <= sfc[10] < 3000
+            assert nc['SFC_SRTM'].units == 'm'
+            assert nc['ALTG_SRTM'].Dependencies == '2 SFC_SRTM GGALT'
+            lo, hi = (float(v.rstrip('f')) for v in nc['SFC_SRTM'].actual_range.split(','))
+            assert lo == 0 and hi == np.round(sfc.max())
+            assert ma.is_masked(nc['ALTG_SRTM'][3005])
+
+    def test_empty_flight(self, flight_file, tmp_path):
+        """A flight with no records gets its variables, but no actual_range."""
+        empty = tmp_path / "TESTrf02.nc"
+        with netCDF4.Dataset(empty, 'w') as nc:
+            nc.createDimension('Time', None)
+            for name in ('Time', 'LATC', 'LONC', 'GGALT', 'GGLAT', 'GGLON'):
+                nc.createVariable(name, 'f4', ('Time',), fill_value=-32767.0)
+        assert HeightOfTerrain_module.write_terrain_variables(str(empty)) == 0
+        with netCDF4.Dataset(empty) as nc:
+            for name in ('SFC_SRTM', 'ALTG_SRTM'):
+                assert nc[name].shape == (0,) and nc[name].units == 'm'
+                assert 'actual_range' not in nc[name].ncattrs()
+
+
+class TestFlightWorkers:
+    """Tests for splitting the records of one flight across worker processes."""
+
+    def test_automatic_worker_count(self, monkeypatch):
+        monkeypatch.setattr(HeightOfTerrain_module.os, 'cpu_count', lambda: 8)
+        flight_workers = HeightOfTerrain_module.flight_workers
+        min_records = HeightOfTerrain_module.PARALLEL_MIN_RECORDS
+        assert flight_workers(5000) == 1
+        assert flight_workers(3 * min_records) == 3
+        assert flight_workers(100 * min_records) == 8
+        assert flight_workers(5000, workers=4) == 4
+        assert flight_workers(2, workers=4) == 2
+
+    def test_record_ranges(self):
+        ranges = HeightOfTerrain_module._record_ranges(10, 5000, 1000, 3)
+        assert ranges[0] == (10, 1010) and ranges[-1][1] == 5000
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+        assert len(HeightOfTerrain_module._record_ranges(0, 5000, 100000, 3)) == 3
+
+    @pytest.mark.parametrize("backend, shared", [("memmap", None), ("array", ["N40W105", "N40W104"])])
+    def test_matches_serial(self, flight_file, tmp_path, monkeypatch, backend, shared):
+        """Parallel lookups give the serial variables, and the workers' counters are kept."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', backend)
+        write = HeightOfTerrain_module.write_terrain_variables
+        copy = tmp_path / "copy.nc"
+        shutil.copy(flight_file, copy)
+        write(str(flight_file), chunk_size=0)
+        reference = _read_outputs(flight_file)
+
+        HeightOfTerrain_module._run_stats.reset()
+        assert write(str(copy), chunk_size=1000, workers=3, shared_tiles=shared) == 5000
+        _assert_same_outputs(_read_outputs(copy), reference)
+        stats = HeightOfTerrain_module._run_stats.as_dict()
+        assert stats['counters']['records'] == 5000
+        assert stats['counters']['samples'] == sum(stats['tile_samples'].values()) > 4900
+        assert stats['stages']['lookup']['calls'] == 10  # Corrected and GPS positions of 5 blocks
+        if shared is not None:
+            assert stats['counters']['tiles_shared'] >= 2
+
+    def test_incremental(self, flight_file, tmp_path):
+        """An incremental run that resumes part way through splits only the new records."""
+        write = HeightOfTerrain_module.write_terrain_variables
+        copy = tmp_path / "copy.nc"
+        shutil.copy(flight_file, copy)
+        write(str(flight_file), chunk_size=0)
+        write(str(copy), chunk_size=0)
+        with netCDF4.Dataset(copy, 'r+') as nc:
+            nc['SFC_SRTM'].setncattr(HeightOfTerrain_module.PROCESSED_ATTR, np.int64(2000))
+        assert write(str(copy), incremental=True, workers=2) == 3000 + HeightOfTerrain_module.INCREMENTAL_OVERLAP
+        _assert_same_outputs(_read_outputs(copy), _read_outputs(flight_file))
+
+
+class TestTerrainMax:
+    """Tests for the highest terrain in a box around a radius, looked up through tile pyramids."""
+
+    @pytest.fixture
+    def mosaic(self, flight_file):
+        """The flight_file tiles N40W105 and N40W104 as one grid, voids as NaN.
+
+        The random tiles do not agree on their shared column; like the
+        lookups, the grid takes it from N40W104.
+        """
+        tdb = HeightOfTerrain_module.TdbData
+        tiles = [np.fromfile(os.path.join(tdb, f"{name}.hgt"), '>i2').reshape(1201, 1201)
+                 for name in ("N40W105", "N40W104")]
+        grid = np.hstack([tiles[0][:, :-1], tiles[1]]).astype(float)
+        grid[grid == -32768] = np.nan
+        return grid
+
+    @pytest.mark.parametrize("radius", [0.5, 2, 10])
+    def test_bounds_box_max(self, mosaic, radius):
+        """The result is at least the box maximum, and at most that of the box grown by one block."""
+        rng = np.random.default_rng(12)
+        lats = np.append(rng.uniform(40.2, 40.8, 200), 40.5)
+        lons = np.append(rng.uniform(-104.8, -103.2, 200), -104.0)  # On the seam
+        result = HeightOfTerrain_module.terrain_max(lats, lons, radius)
+        dlat = radius / HeightOfTerrain_module.KM_PER_DEGREE
+        for lat, lon, value in zip(lats, lons, result):
+            dlon = dlat / np.cos(np.radians(lat))
+            r0, r1 = int(np.ceil((41 - lat - dlat) * 1200)), int(np.floor((41 - lat + dlat) * 1200))
+            c0, c1 = int(np.ceil((lon + 105 - dlon) * 1200)), int(np.floor((lon + 105 + dlon) * 1200))
+            grow = max(2, (max(r1 - r0, c1 - c0) + 1) // 8)
+            box = np.nanmax(mosaic[r0:r1 + 1, c0:c1 + 1])
+            grown = np.nanmax(mosaic[max(r0 - grow, 0):r1 + grow + 1, max(c0 - grow, 0):c1 + grow + 1])
+            assert box <= value <= grown
+
+    def test_voids_and_missing(self, flight_file):
+        """Voids and unavailable tiles never count; masked positions give NaN."""
+        lats = np.ma.masked_array([40.96, 40.5, 45.5, 40.5], mask=[0, 0, 0, 1])
+        lons = np.array([-104.96, -104.5, -104.5, -104.5])
+        result = HeightOfTerrain_module.terrain_max(lats, lons, 1)
+        assert np.isnan(result[0])  # The void NW corner of N40W105
+        assert 1000 <= result[1] < 3000
+        assert np.isnan(result[2]) and np.isnan(result[3])
+
+    def test_across_antimeridian(self, tmp_path, monkeypatch):
+        """A window near the antimeridian takes in the tile on its other side."""
+        np.full((1201, 1201), 100, dtype='>i2').tofile(tmp_path / "N40W180.hgt")
+        peak = np.full((1201, 1201), 50, dtype='>i2')
+        peak[600, 1199] = 900  # 40.5N 179.999E
+        peak.tofile(tmp_path / "N40E179.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        result = HeightOfTerrain_module.terrain_max([40.5, 40.5, 40.5], [-179.99, -179.9, 179.5], 2)
+        np.testing.assert_array_equal(result, [900, 100, 50])
+
+    def test_pyramid_saved_and_rebuilt(self, flight_file, mosaic):
+        """Pyramids are saved next to the tile index, reused, and rebuilt when the tile changes."""
+        stats = HeightOfTerrain_module._run_stats
+        cache = HeightOfTerrain_module._pyramid_cache
+        terrain_max = HeightOfTerrain_module.terrain_max
+        tdb = HeightOfTerrain_module.TdbData
+        saved = os.path.join(tdb, HeightOfTerrain_module.TILE_INDEX_DIR,
+                             HeightOfTerrain_module.PYRAMID_DIR, "N40W105.npy")
+        stats.reset()
+        expected = terrain_max([40.5], [-104.5], 20)
+        assert os.path.exists(saved) and stats.counters['pyramids_built'] == 1
+        cache.clear()
+        assert terrain_max([40.5], [-104.5], 20) == expected
+        assert stats.counters['pyramids_built'] == 1
+        assert isinstance(cache.get(saved).data, np.memmap)
+
+        tile = os.path.join(tdb, "N40W105.hgt")
+        data = np.fromfile(tile, '>i2').reshape(1201, 1201)
+        data[600, 600] = 8000
+        data.tofile(tile)
+        os.utime(tile, ns=(os.stat(saved).st_mtime_ns + 10**9,) * 2)
+        cache.clear()
+        _terrain_cache.clear()
+        assert terrain_max([40.5], [-104.5], 20) == 8000
+        assert stats.counters['pyramids_built'] == 2
+
+    def test_planning_covers_windows(self, tmp_path, monkeypatch):
+        """Track planning and the fingerprint take in the tiles the radius windows reach."""
+        np.full((1201, 1201), 50, dtype='>i2').tofile(tmp_path / "N60W105.hgt")
+        peak = np.full((1201, 1201), 100, dtype='>i2')
+        peak[600, :5] = 900  # 60.5N just east of 104W, 6.6 km from the track
+        peak.tofile(tmp_path / "N60W104.hgt")
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        flight = tmp_path / "TESTrf02.nc"
+        with netCDF4.Dataset(flight, 'w') as nc:
+            nc.createDimension('Time', 10)
+            for name in ('Time', 'LATC', 'LONC', 'GGALT', 'GGLAT', 'GGLON'):
+                nc.createVariable(name, 'f4', ('Time',))
+            nc['Time'][:] = np.arange(10)
+            nc['LATC'][:] = nc['GGLAT'][:] = 60.5
+            nc['LONC'][:] = nc['GGLON'][:] = -104.12
+            nc['GGALT'][:] = 3000
+
+        def fingerprints():
+            with netCDF4.Dataset(flight) as nc:
+                before = HeightOfTerrain_module.flight_fingerprint(nc)
+                stat = os.stat(tmp_path / "N60W104.hgt")
+                os.utime(tmp_path / "N60W104.hgt", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+                return before, HeightOfTerrain_module.flight_fingerprint(nc)
+
+        plan = HeightOfTerrain_module.plan_flight_tiles
+        assert plan(str(flight)) == {(60, -105)}
+        before, after = fingerprints()
+        assert before == after
+        monkeypatch.setattr(HeightOfTerrain_module, 'TerrainMaxRadii', (1, 10))
+        assert plan(str(flight)) == {(60, -105), (60, -104)}
+        assert HeightOfTerrain_module.terrain_max([60.5], [-104.12], 10)[0] == 900
+        before, after = fingerprints()
+        assert before != after
+
+    def test_written_variables(self, flight_file, tmp_path, monkeypatch):
+        """write_terrain_variables writes one variable per radius, the same in parallel."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'TerrainMaxRadii', (1, 2.5))
+        write = HeightOfTerrain_module.write_terrain_variables
+        copy = tmp_path / "copy.nc"
+        shutil.copy(flight_file, copy)
+        write(str(flight_file), chunk_size=0)
+        write(str(copy), chunk_size=1000, workers=2)
+        names = ('SFCMAX1K_SRTM', 'SFCMAX2P5K_SRTM')
+        with netCDF4.Dataset(flight_file) as nc, netCDF4.Dataset(copy) as nc_copy:
+            for name in names:
+                assert ma.allequal(nc[name][:], nc_copy[name][:])
+                assert nc[name].units == 'm' and "box of at least 2.5 km" in nc['SFCMAX2P5K_SRTM'].long_name
+            near, far = nc[names[0]][:], nc[names[1]][:]
+            assert not ma.is_masked(far) and np.all(far >= near)
+        _assert_same_outputs(_read_outputs(copy), _read_outputs(flight_file))
+
+
+class TestXarray:
+    """Tests for computing the terrain variables of xarray datasets with Dask."""
+
+    @pytest.fixture
+    def reference(self, flight_file, tmp_path):
+        """The variables write_terrain_variables() writes for flight_file, masked as NaN."""
+        copy = tmp_path / "copy.nc"
+        shutil.copy(flight_file, copy)
+        HeightOfTerrain_module.write_terrain_variables(str(copy))
+        with netCDF4.Dataset(copy) as nc:
+            outputs = {name: ma.filled(nc[name][:].astype('f4'), np.nan) for name in ('SFC_SRTM', 'ALTG_SRTM')}
+        # xarray cannot tell masked corrected positions from NaN ones; both use GPS
+        keep = np.ones(5000, dtype=bool)
+        keep[2000:2011] = False
+        return outputs, keep
+
+    @pytest.fixture(autouse=True)
+    def cache_budget(self):
+        budget = (_terrain_cache.max_bytes, _terrain_cache.max_tiles)
+        yield
+        _terrain_cache.resize(*budget)
+
+    @pytest.mark.parametrize("chunks", [None, {'Time': 700}, {'Time': 333}])
+    def test_matches_cli(self, flight_file, reference, chunks):
+        """Lazy results, chunked any way, match the variables written by the CLI."""
+        xr = pytest.importorskip("xarray")
+        if chunks is not None:
+            pytest.importorskip("dask")
+        outputs, keep = reference
+        with xr.open_dataset(flight_file, chunks=chunks) as ds:
+            result = HeightOfTerrain_module.terrain_dataset(ds)
+            assert (result['SFC_SRTM'].chunks is None) == (chunks is None)
+            result = result.compute()
+        for name, expected in outputs.items():
+            assert result[name].dtype == np.float32 and result[name].attrs['units'] == 'm'
+            np.testing.assert_array_equal(result[name].values[keep], expected[keep])
+        assert np.all(result['SFC_SRTM'].values[2000:2010] > 0)  # From the GPS position
+
+    def test_worker_processes(self, flight_file, reference):
+        """Under the multiprocessing scheduler each worker process applies the settings and cache budget."""
+        xr = pytest.importorskip("xarray")
+        dask = pytest.importorskip("dask")
+        outputs, keep = reference
+        with xr.open_dataset(flight_file, chunks={'Time': 1000}) as ds:
+            result = HeightOfTerrain_module.terrain_dataset(ds, cache_bytes=1)
+            with dask.config.set(scheduler='processes', num_workers=2, **{'multiprocessing.context': 'fork'}):
+                result = result.compute()
+        np.testing.assert_array_equal(result['ALTG_SRTM'].values[keep], outputs['ALTG_SRTM'][keep])
+
+    def test_threads_keep_caller_cache(self, flight_file):
+        """Under the threaded scheduler the caller's tile cache and budget are left alone."""
+        xr = pytest.importorskip("xarray")
+        pytest.importorskip("dask")
+        _terrain_cache.clear()
+        budget = _terrain_cache.max_bytes
+        _terrain_cache.put("N00E000", HeightOfTerrain_module.Tile("N00E000", np.zeros((1201, 1201), dtype=np.float32)))
+        with xr.open_dataset(flight_file, chunks={'Time': 1000}) as ds:
+            HeightOfTerrain_module.terrain_dataset(ds, cache_bytes=1).compute(scheduler='threads')
+        assert _terrain_cache.max_bytes == budget
+        assert "N00E000" in _terrain_cache and "N40W105" in _terrain_cache
+        assert HeightOfTerrain_module._applied_config is None
+        _terrain_cache.clear()
+
+
+class TestPrefetch:
+    """Tests for loading tiles in background threads ahead of the lookups."""
+
+    def test_queue_depth(self, monkeypatch):
+        """At most depth tiles load at once; a queued tile needed now is left to the caller."""
+        release = threading.Event()
+        loaded = []
+
+        def fetch(vname, stage='tile_load'):
+            release.wait(5)
+            loaded.append(vname)
+            tile = HeightOfTerrain_module.Tile(vname, np.zeros((1201, 1201), dtype=np.float32))
+            _terrain_cache.put(vname, tile)
+            return tile
+
+        monkeypatch.setattr(HeightOfTerrain_module, '_fetch_tile', fetch)
+        _terrain_cache.clear()
+        prefetcher = HeightOfTerrain_module.TilePrefetcher(1, depth=2)
+        try:
+            prefetcher.schedule(["N40W105", "N40W104", "N41W105", "N41W104", "N40W105"])
+            assert len(prefetcher._loading) == 2
+            assert list(prefetcher._queued) == ["N41W105", "N41W104"]
+            assert prefetcher.wait("N41W104") is None
+            release.set()
+            assert prefetcher.wait("N40W104").name == "N40W104"
+        finally:
+            prefetcher.close()
+            _terrain_cache.clear()
+        assert loaded[:2] == ["N40W105", "N40W104"] and "N41W104" not in loaded
+
+    def test_matches_on_demand(self, flight_file, tmp_path, monkeypatch):
+        """Prefetched runs write the same variables, reading each tile once and timing the stalls."""
+        opened = []
+        open_tile = HeightOfTerrain_module._open_tile
+
+        def slow_open(vname, path):
+            opened.append(vname)
+            time.sleep(0.05)
+            return open_tile(vname, path)
+
+        monkeypatch.setattr(HeightOfTerrain_module, '_open_tile', slow_open)
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', "array")
+        write = HeightOfTerrain_module.write_terrain_variables
+        copy = tmp_path / "copy.nc"
+        shutil.copy(flight_file, copy)
+        write(str(flight_file), chunk_size=1000)
+        _terrain_cache.clear()
+        opened.clear()
+
+        monkeypatch.setattr(HeightOfTerrain_module, 'PrefetchWorkers', 2)
+        HeightOfTerrain_module._run_stats.reset()
+        write(str(copy), chunk_size=1000)
+        _assert_same_outputs(_read_outputs(copy), _read_outputs(flight_file))
+        assert sorted(opened) == ["N40W104", "N40W105"]
+        stats = HeightOfTerrain_module._run_stats.as_dict()
+        assert stats['counters']['tiles_prefetched'] == 2
+        assert 'tile_load' not in stats['stages']
+        assert stats['stages']['prefetch_stall']['wall'] <= stats['stages']['prefetch_load']['wall']
+        assert HeightOfTerrain_module._prefetcher is None
+
+    def test_positions_read_once(self, flight_file, monkeypatch):
+        """Prefetching looks ahead within a single write block and reads each position block once."""
+        reads = []
+        read_position_vars = HeightOfTerrain_module._read_position_vars
+
+        def counting_read(nc_data, start, stop):
+            reads.append((start, stop))
+            return read_position_vars(nc_data, start, stop)
+
+        monkeypatch.setattr(HeightOfTerrain_module, '_read_position_vars', counting_read)
+        monkeypatch.setattr(HeightOfTerrain_module, 'PrefetchWorkers', 2)
+        monkeypatch.setattr(HeightOfTerrain_module, 'PREFETCH_RECORDS', 1000)
+        _terrain_cache.clear()
+        HeightOfTerrain_module.write_terrain_variables(str(flight_file), chunk_size=0)
+        with netCDF4.Dataset(flight_file) as nc:
+            n = nc.variables['Time'].shape[0]
+        assert len(reads) > 1
+        assert reads == [(start, min(start + 1000, n)) for start in range(0, n, 1000)]
+        _terrain_cache.clear()
+
+
+class TestStartup:
+    """Tests for keeping the module import light."""
+
+    def test_import_skips_heavy_modules(self):
+        """Importing the module for its lookup functions loads neither netCDF4 nor SciPy."""
+        import subprocess
+        code = (f"import importlib.machinery, importlib.util, sys\n"
+                f"loader = importlib.machinery.SourceFileLoader('HeightOfTerrain', {_script_path!r})\n"
+                f"module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))\n"
+                f"loader.exec_module(module)\n"
+                f"print(' '.join(m for m in ('netCDF4', 'scipy', 'pandas', 'urllib.request', 'asyncio', "
+                f"'multiprocessing') if m in sys.modules))")
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        assert result.stdout.strip() == ""
+
+    def test_gap_fill_matches_scipy(self):
+        """The NumPy gap fill reproduces interp1d at its knots bit for bit."""
+        interp1d = pytest.importorskip("scipy.interpolate").interp1d
+        rng = np.random.default_rng(4)
+        for n in (2, 3, 50, 1000):
+            y = rng.uniform(-500, 5000, n)
+            y[rng.random(n) < 0.2] = np.nan
+            x = np.arange(n)
+            expected = interp1d(x, y, kind='linear', fill_value='extrapolate')(x)
+            expected[np.isnan(expected)] = 0
+            assert np.array_equal(HeightOfTerrain_module.fill_terrain_gaps(y), expected)
+
+
+class TestIncremental:
+    """Tests for incremental processing of growing flight files."""
+
+    NAMES = ('Time', 'LATC', 'LONC', 'GGALT', 'GGLAT', 'GGLON')
+
+    @pytest.fixture
+    def growing(self, flight_file, tmp_path):
+        """Returns (path, append) for a flight file with an unlimited Time dimension."""
+        with netCDF4.Dataset(flight_file) as nc:
+            data = {name: nc[name][:] for name in self.NAMES}
+        path = tmp_path / "TESTrf09.nc"
+        with netCDF4.Dataset(path, 'w') as nc:
+            nc.createDimension('Time', None)
+            for name in self.NAMES:
+                nc.createVariable(name, 'f4', ('Time',), fill_value=-32767.0)
+
+        def append(stop):
+            with netCDF4.Dataset(path, 'a') as nc:
+                start = len(nc.dimensions['Time'])
+                for name in self.NAMES:
+                    nc[name][start:stop] = data[name][start:stop]
+        return path, append
+
+    def test_growing_file_matches_full_run(self, growing, flight_file):
+        path, append = growing
+        write = HeightOfTerrain_module.write_terrain_variables
+        overlap = HeightOfTerrain_module.INCREMENTAL_OVERLAP
+        append(1)
+        assert write(str(path), chunk_size=1000, incremental=True) == 1
+        append(2000)
+        assert write(str(path), chunk_size=1000, incremental=True) == 2000
+        append(3003)
+        assert write(str(path), chunk_size=1000, incremental=True) == 1003 + overlap
+        assert write(str(path), chunk_size=1000, incremental=True) == overlap
+        append(5000)
+        assert write(str(path), chunk_size=300, incremental=True) == 1997 + overlap
+        with netCDF4.Dataset(path) as nc:
+            assert nc['SFC_SRTM'].getncattr(HeightOfTerrain_module.PROCESSED_ATTR) == 5000
+
+        write(str(flight_file), chunk_size=0)
+        _assert_same_outputs(_read_outputs(path), _read_outputs(flight_file))
+
+    def test_without_state_processes_everything(self, growing):
+        path, append = growing
+        append(3000)
+        write = HeightOfTerrain_module.write_terrain_variables
+        assert write(str(path), chunk_size=1000) == 3000
+        # Not incremental: everything again
+        assert write(str(path), chunk_size=1000) == 3000
+        with netCDF4.Dataset(path, 'a') as nc:
+            nc['SFC_SRTM'].setncattr(HeightOfTerrain_module.PROCESSED_ATTR, 4000)
+        # State from a longer file than this one is not trusted
+        assert write(str(path), chunk_size=1000, incremental=True) == 3000
+
+    def test_watch(self, growing, capsys):
+        path, append = growing
+        append(2000)
+        HeightOfTerrain_module.watch_flight(str(path), interval=0.01, idle_timeout=0.2)
+        out = capsys.readouterr().out
+        assert out.count("Updated") == 1
+        assert "Updated 2000 records" in out and "stopping" in out
+
+
+class TestFingerprint:
+    """Tests for skipping flights whose inputs have not changed."""
+
+    def test_skip_unchanged(self, flight_file, monkeypatch, capsys):
+        write = HeightOfTerrain_module.write_terrain_variables
+        attr = HeightOfTerrain_module.FINGERPRINT_ATTR
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 5000
+        with netCDF4.Dataset(flight_file) as nc:
+            fingerprint = nc['SFC_SRTM'].getncattr(attr)
+            assert nc['ALTG_SRTM'].getncattr(attr) == fingerprint
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 0
+        assert "inputs unchanged" in capsys.readouterr().out
+        # Block size does not change the fingerprint
+        assert write(str(flight_file), chunk_size=333, skip_unchanged=True) == 0
+        assert write(str(flight_file), chunk_size=1000) == 5000
+
+        # Changed options, positions and tiles all change the fingerprint
+        monkeypatch.setattr(HeightOfTerrain_module, 'Interpolation', 'bilinear')
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 5000
+        with netCDF4.Dataset(flight_file, 'a') as nc:
+            nc['GGALT'][10] = 1234.0
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 5000
+        tile = os.path.join(HeightOfTerrain_module.TdbData, "N40W104.hgt")
+        os.utime(tile, ns=(0, 10**9))
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 5000
+        assert write(str(flight_file), chunk_size=1000, skip_unchanged=True) == 0
+
+    def test_missing_tiles(self, flight_file):
+        """Tiles missing from the database are part of the fingerprint too."""
+        versions = HeightOfTerrain_module._tile_versions({(40, -104), (41, -104)})
+        assert versions[0].startswith("N40W104:") and versions[1] == "N41W104:missing"
+
+    def test_incremental_drops_fingerprint(self, flight_file):
+        write = HeightOfTerrain_module.write_terrain_variables
+        write(str(flight_file), chunk_size=1000)
+        write(str(flight_file), chunk_size=1000, incremental=True)
+        with netCDF4.Dataset(flight_file) as nc:
+            assert HeightOfTerrain_module.FINGERPRINT_ATTR not in nc['SFC_SRTM'].ncattrs()
+
+    def test_main_force(self, flight_file, capsys):
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(flight_file.parent), '40', '40', '-105', '-104', 'no']
+        for extra, skipped in (([], False), ([], True), (['--force'], False)):
+            with mock.patch('sys.argv', argv + extra):
+                HeightOfTerrain_module.main()
+            assert ("inputs unchanged" in capsys.readouterr().out) == skipped
+
+    def test_skipped_flight_not_preloaded(self, flight_file, capsys):
+        """Planned tiles are preloaded only for a flight that is not skipped."""
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(flight_file.parent), '--margin', '0']
+        for skipped in (False, True):
+            _terrain_cache.clear()
+            with mock.patch('sys.argv', argv), \
+                    mock.patch.object(HeightOfTerrain_module, 'preload_tiles',
+                                      wraps=HeightOfTerrain_module.preload_tiles) as preload:
+                HeightOfTerrain_module.main()
+            assert ("inputs unchanged" in capsys.readouterr().out) == skipped
+            assert preload.called != skipped
+            assert (len(_terrain_cache) == 0) == skipped
+        _terrain_cache.clear()
+
+
+class TestProjectDriver:
+    """Tests for processing all flights of a project in one run."""
+
+    @pytest.fixture
+    def project_dir(self, flight_file, tmp_path):
+        project_dir = tmp_path / "project"
+        project_dir.mkdir()
+        for flight in ("rf01", "rf02", "tf01"):
+            shutil.copy(flight_file, project_dir / f"TEST{flight}.nc")
+        (project_dir / "TESTrf03.nc").write_bytes(b"not netCDF")
+        (project_dir / "OTHERrf01.nc").write_bytes(b"other project")
+        return project_dir
+
+    def test_find_flight_files(self, project_dir):
+        names = [os.path.basename(f) for f in
+                 HeightOfTerrain_module.find_flight_files(str(project_dir), "TEST")]
+        assert names == ["TESTrf01.nc", "TESTrf02.nc", "TESTrf03.nc", "TESTtf01.nc"]
+
+    def test_parallel_matches_serial(self, project_dir, flight_file):
+        """Flights processed by worker processes match a serial run; failures are reported."""
+        fnames = HeightOfTerrain_module.find_flight_files(str(project_dir), "TEST")
+        results = HeightOfTerrain_module.process_flights(fnames, workers=3, chunk_size=1000)
+        assert [r['ok'] for r in results] == [True, True, False, True]
+        assert "TESTrf03.nc" in results[2]['file'] and results[2]['error']
+
+        HeightOfTerrain_module.write_terrain_variables(str(flight_file), chunk_size=0)
+        reference = _read_outputs(flight_file)
+        for fname in (fnames[0], fnames[1], fnames[3]):
+            _assert_same_outputs(_read_outputs(fname), reference)
+
+    def test_parallel_shared_tiles(self, project_dir, flight_file):
+        """Workers attach to tiles published once in shared memory, which are unlinked afterwards."""
+        fnames = HeightOfTerrain_module.find_flight_files(str(project_dir), "TEST")
+        del fnames[2]  # Not a netCDF file
+        results = HeightOfTerrain_module.process_flights(
+            fnames, workers=2, chunk_size=1000, shared_tiles=["N40W105", "N40W104", "N41W105"])
+        assert all(r['ok'] for r in results)
+        counters = [r['report']['counters'] for r in results]
+        assert all('tiles_loaded' not in c for c in counters)  # Tiles were never read from files
+        assert any(c.get('tiles_shared') == 2 for c in counters)
+        if os.path.isdir("/dev/shm"):
+            prefix = f"{HeightOfTerrain_module.SHARED_TILE_PREFIX}{os.getpid()}_"
+            assert not [f for f in os.listdir("/dev/shm") if f.startswith(prefix)]
+
+        HeightOfTerrain_module.write_terrain_variables(str(flight_file), chunk_size=0)
+        reference = _read_outputs(flight_file)
+        for fname in fnames:
+            _assert_same_outputs(_read_outputs(fname), reference)
+
+    def test_main_all_flights(self, project_dir, capsys):
+        """--all-flights processes every flight and exits non-zero if one failed."""
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(project_dir), '40', '40', '-105', '-104', 'no',
+                '--all-flights', '--workers', '2']
+        with mock.patch('sys.argv', argv), pytest.raises(SystemExit) as exc:
+            HeightOfTerrain_module.main()
+        assert exc.value.code == 1
+        out = capsys.readouterr().out
+        assert "3 of 4 flights processed successfully" in out
+        assert "FAILED TESTrf03.nc" in out
+
+
+class TestSharedTiles:
+    """Tests for publishing tiles in shared memory and attaching to them."""
+
+    @pytest.mark.parametrize("backend, tile_class", [("memmap", "SharedRawTile"), ("array", "SharedTile")])
+    def test_attach_read_only(self, flight_file, monkeypatch, backend, tile_class):
+        monkeypatch.setattr(HeightOfTerrain_module, 'TileBackend', backend)
+        expected = HeightOfTerrain_module._load_tile("N40W105").gather(*np.indices((1201, 1201)))
+        _terrain_cache.clear()
+        with HeightOfTerrain_module.SharedTileStore() as store:
+            assert store.publish(["N40W105", "N10E010"]) == 1
+            monkeypatch.setattr(HeightOfTerrain_module, '_shared_tiles', store.specs())
+            tile = HeightOfTerrain_module._load_tile("N40W105")
+            assert type(tile).__name__ == tile_class
+            assert not tile.data.flags.writeable
+            np.testing.assert_array_equal(tile.gather(*np.indices((1201, 1201))), expected)
+            segment = store.specs()["N40W105"][0]
+        with pytest.raises(FileNotFoundError):
+            HeightOfTerrain_module._attach_segment(segment)
+
+    def test_publish_stops_at_budget(self, flight_file):
+        """Publishing stops before the store would exceed max_bytes."""
+        tile_bytes = 1201 * 1201 * 2
+        with HeightOfTerrain_module.SharedTileStore() as store:
+            assert store.publish(["N40W105", "N40W104"], max_bytes=tile_bytes + 100) == 1
+            assert list(store.specs()) == ["N40W105"] and store.bytes == tile_bytes
+
+    def test_compact_tiles_decoded_once(self, flight_file, monkeypatch):
+        terrain_dir = HeightOfTerrain_module.TdbData
+        HeightOfTerrain_module.convert_hgt_tree(terrain_dir, remove_source=True)
+        HeightOfTerrain_module._tile_indexes.clear()
+        with HeightOfTerrain_module.SharedTileStore() as store:
+            assert store.publish(["N40W104"]) == 1
+            monkeypatch.setattr(HeightOfTerrain_module, '_shared_tiles', store.specs())
+            tile = HeightOfTerrain_module._load_tile("N40W104")
+            assert isinstance(tile, HeightOfTerrain_module.SharedRawTile)
+            compact = HeightOfTerrain_module.CompactTile("N40W104", os.path.join(terrain_dir, "N40W104.hgc"))
+            np.testing.assert_array_equal(tile.data, compact.decode_all())
+
+
+class TestRunReport:
+    """Tests for stage timings, counters and the --report JSON summaries."""
+
+    def test_run_stats(self):
+        stats = HeightOfTerrain_module.RunStats()
+        for _ in range(2):
+            with stats.stage('lookup'):
+                stats.count('samples', 10)
+        stats.count_tile("N40W105", 7)
+        result = stats.as_dict()
+        assert result['stages']['lookup']['calls'] == 2
+        assert result['stages']['lookup']['wall'] >= 0
+        assert result['counters'] == {'samples': 20}
+        assert result['tile_samples'] == {"N40W105": 7}
+        stats.reset()
+        assert stats.as_dict() == {'stages': {}, 'counters': {}, 'tile_samples': {}}
+
+    def test_single_flight_report(self, flight_file, tmp_path):
+        report_dir = tmp_path / "reports"
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(flight_file.parent), '40', '40', '-105', '-104', 'no',
+                '--chunk-size', '1000', '--report', str(report_dir), '--profile', str(report_dir)]
+        with mock.patch('sys.argv', argv):
+            HeightOfTerrain_module.main()
+        report = json.loads((report_dir / "TESTrf01_terrain_report.json").read_text())
+        assert report['ok'] and report['file'] == str(flight_file)
+        assert {'lookup', 'gap_fill', 'netcdf_read', 'netcdf_write', 'tile_load'} <= set(report['stages'])
+        assert report['stages']['gap_fill']['calls'] == 5
+        assert report['counters']['records'] == 5000
+        assert report['counters']['tiles_loaded'] == 2
+        assert set(report['tile_samples']) == {"N40W105", "N40W104"}
+        assert report['cache']['misses'] == 2
+        assert report['options']['interpolation'] == 'nearest'
+        assert 'setup' in report
+        assert (report_dir / "TESTrf01.prof").exists()
+
+    def test_all_flights_reports(self, flight_file, tmp_path):
+        project_dir = tmp_path / "project"
+        project_dir.mkdir()
+        for flight in ("rf01", "rf02"):
+            shutil.copy(flight_file, project_dir / f"TEST{flight}.nc")
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(project_dir), '40', '40', '-105', '-104', 'no',
+                '--all-flights', '--workers', '2', '--report', str(tmp_path / "reports")]
+        with mock.patch('sys.argv', argv):
+            HeightOfTerrain_module.main()
+        for flight in ("rf01", "rf02"):
+            report = json.loads((tmp_path / "reports" / f"TEST{flight}_terrain_report.json").read_text())
+            assert report['counters']['records'] == 5000
+            assert report['counters']['samples'] > 0
+
+
+class TestTerrainServer:
+    """Tests for the lookup server and client, on localhost."""
+
+    @pytest.fixture
+    def start_server(self, flight_file):
+        """Start TerrainServers on a background event loop; returns a starter function."""
+        import asyncio
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        servers = []
+
+        def start(address, method=None):
+            server = HeightOfTerrain_module.TerrainServer(address, method)
+            asyncio.run_coroutine_threadsafe(server.start(), loop).result(10)
+            servers.append(server)
+            return server
+
+        yield start
+        for server in servers:
+            asyncio.run_coroutine_threadsafe(server.close(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        loop.close()
+
+    def test_binary_and_json(self, start_server):
+        server = start_server("127.0.0.1:0")
+        lats = np.linspace(40.01, 40.99, 200)
+        lons = np.linspace(-104.99, -103.01, 200)
+        lats[5] = np.nan
+        expected = HeightOfTerrainArray(lats, lons)
+        with HeightOfTerrain_module.TerrainClient(server.address, timeout=10) as client:
+            assert np.array_equal(client.heights(lats, lons), expected, equal_nan=True)
+            reply = client.query({'lat': [40.5, 50.5], 'lon': [-104.5, -104.5]})
+            assert reply['sfc'] == [HeightOfTerrain(40.5, -104.5), None]
+            assert 'error' in client.query({'lat': [1, 2], 'lon': [3]})
+            status = client.status()
+        assert status['requests'] == 2 and status['samples'] == 202
+        assert status['errors'] == 1 and status['clients'] == 1
+        assert status['latency_ms']['p99'] >= status['latency_ms']['p50'] > 0
+        assert status['cache']['tiles'] == 2
+
+    def test_unix_socket_and_concurrent_clients(self, start_server, tmp_path):
+        address = str(tmp_path / "terrain.sock")
+        start_server(address, method="bilinear")
+        rng = np.random.default_rng(3)
+        lats = rng.uniform(40.01, 40.99, (8, 500))
+        lons = rng.uniform(-104.99, -103.01, (8, 500))
+        results = [None] * 8
+
+        def ask(i):
+            with HeightOfTerrain_module.TerrainClient(address, timeout=10) as client:
+                for _ in range(5):
+                    results[i] = client.heights(lats[i], lons[i])
+
+        threads = [threading.Thread(target=ask, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(30)
+        for i in range(8):
+            assert np.array_equal(results[i], HeightOfTerrainArray(lats[i], lons[i], "bilinear"),
+                                  equal_nan=True)
+
+    def test_bad_frame_drops_client(self, start_server):
+        server = start_server("127.0.0.1:0")
+        host, port = server.address.rsplit(':', 1)
+        import socket
+        with socket.create_connection((host, int(port)), timeout=10) as sock:
+            sock.sendall(b"GET / HTTP/1.0\r\n\r\n")
+            assert sock.recv(100) == b""
+        with HeightOfTerrain_module.TerrainClient(server.address, timeout=10) as client:
+            assert client.status()['errors'] == 1
+
+    def test_long_json_lines(self, start_server, monkeypatch):
+        """JSON batches beyond asyncio's default line limit work; overlong lines get an error."""
+        server = start_server("127.0.0.1:0")
+        lats = np.linspace(40.01, 40.99, 5000)
+        lons = np.linspace(-104.99, -103.01, 5000)
+        with HeightOfTerrain_module.TerrainClient(server.address, timeout=10) as client:
+            reply = client.query({'lat': lats.tolist(), 'lon': lons.tolist()})
+        assert reply['sfc'] == HeightOfTerrainArray(lats, lons).tolist()
+
+        monkeypatch.setattr(HeightOfTerrain_module, 'SERVER_LINE_LIMIT', 1000)
+        small = start_server("127.0.0.1:0")
+        with HeightOfTerrain_module.TerrainClient(small.address, timeout=10) as client:
+            assert 'error' in client.query({'lat': lats.tolist(), 'lon': lons.tolist()})
+        with HeightOfTerrain_module.TerrainClient(small.address, timeout=10) as client:
+            assert client.status()['errors'] == 1
+
+    def test_socket_path_not_a_socket(self, tmp_path):
+        """A regular file at the socket path is left alone."""
+        import asyncio
+        path = tmp_path / "terrain.sock"
+        path.write_text("keep me")
+        with pytest.raises(FileExistsError):
+            asyncio.run(HeightOfTerrain_module.TerrainServer(str(path)).start())
+        assert path.read_text() == "keep me"
+
+    def test_region_tiles(self):
+        assert HeightOfTerrain_module.region_tiles(40, 41, -105, -104) == [
+            "N40W105", "N40W104", "N41W105", "N41W104"]
+        assert HeightOfTerrain_module.region_tiles(-19, -19, 179, -180) == ["S19E179", "S19W180"]
+
+
+class TestTilePlanning:
+    """Tests for planning the tiles along a flight track."""
+
+    def test_track_tiles(self):
+        """Only the cells the track crosses are planned, plus the margin."""
+        plan_tiles = HeightOfTerrain_module.plan_tiles
+        lats = np.linspace(40.5, 42.5, 100)
+        lons = np.linspace(-104.5, -104.5, 100)
+        assert plan_tiles(lats, lons, margin=0) == {(40, -105), (41, -105), (42, -105)}
+        # A margin reaches into the neighboring tiles near a seam
+        assert plan_tiles([40.95], [-104.05], margin=0.1) == {
+            (40, -105), (41, -105), (40, -104), (41, -104)}
+        # Margins over a degree do not skip tiles
+        assert len(plan_tiles([40.5], [-104.5], margin=1.5)) == 16
+        assert plan_tiles([np.nan, 95.0], [-104.5, 0.0]) == set()
+
+    def test_antimeridian(self):
+        tiles = HeightOfTerrain_module.plan_tiles([-18.5], [179.95], margin=0.1)
+        assert tiles == {(-19, 179), (-19, -180)}
+
+    def test_plan_reports_only_what_is_needed(self, tmp_path, monkeypatch, capsys):
+        """Available tiles and archives known to be missing are not fetched."""
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        np.zeros((1201, 1201), dtype='>i2').tofile(tmp_path / "N40W105.hgt")
+        HeightOfTerrain_module.ArchiveManifest(str(tmp_path)).record("J13", {
+            'missing': True, 'base_url': HeightOfTerrain_module.ARCHIVE_BASE_URL, 'time': time.time()})
+        tiles = {(40, -105), (41, -105), (42, -104), (36, -105)}
+        plan = HeightOfTerrain_module.plan_terrain_database(tiles)
+        assert plan['available'] == ["N40W105"]
+        assert plan['archives'] == {"K13": ["N41W105", "N42W104"]}
+        assert plan['download_bytes'] == HeightOfTerrain_module.ARCHIVE_SIZE_ESTIMATE
+        assert plan['extract_bytes'] == 2 * HeightOfTerrain_module.TILE_BYTES
+        HeightOfTerrain_module.print_terrain_plan(plan)
+        out = capsys.readouterr().out
+        assert "4 tiles on the track, 1 already available, 2 to fetch" in out
+        assert "Archives: K13" in out
+
+    def test_prepare_planned_tiles(self, tmp_path, archive_server, monkeypatch):
+        """Only planned tiles are extracted from an archive, and they are preloaded."""
+        archive_server.files["K13.zip"] = _make_archive("K13", {"N40W105": 1500, "N41W105": 1600})
+        monkeypatch.setattr(HeightOfTerrain_module, 'TdbData', str(tmp_path))
+        _terrain_cache.clear()
+        plan = HeightOfTerrain_module.plan_terrain_database({(40, -105)})
+        HeightOfTerrain_module.prepare_terrain_database(
+            list(plan['archives']), base_url=archive_server.url, tiles=plan['tiles'])
+        assert (tmp_path / "K13" / "N40W105.hgt").exists()
+        assert not (tmp_path / "K13" / "N41W105.hgt").exists()
+        assert "N40W105" in _terrain_cache
+        assert HeightOfTerrain(40.5, -104.5) == 1500
+
+        # The rest of the downloaded archive stays readable without a refetch
+        plan = HeightOfTerrain_module.plan_terrain_database({(40, -105), (41, -105)})
+        assert plan['available'] == ["N40W105", "N41W105"] and plan['archives'] == {}
+        assert HeightOfTerrain(41.5, -104.5) == 1600
+        _terrain_cache.clear()
+        HeightOfTerrain_module._zip_handles.close()
+
+    def test_preload_respects_cache_budget(self, flight_file, monkeypatch):
+        monkeypatch.setattr(_terrain_cache, 'max_tiles', 1)
+        assert HeightOfTerrain_module.preload_tiles(["N40W105", "N40W104"]) == 1
+        assert len(_terrain_cache) == 1
+
+    def test_main_plans_from_track(self, flight_file):
+        """Without bounds, main() prepares only the tiles along the track."""
+        argv = ['HeightOfTerrain', 'TEST', 'rf01', str(flight_file.parent), '--chunk-size', '1000',
+                '--margin', '0']
+        with mock.patch('sys.argv', argv), \
+                mock.patch.object(HeightOfTerrain_module, 'prepare_terrain_database') as prepare:
+            HeightOfTerrain_module.main()
+        # Both tiles under the track are in the database already
+        assert prepare.call_args[0][0] == []
+        assert prepare.call_args[1]['tiles'] == ["N40W105", "N40W104"]
+
+
+class TestBenchmark:
+    """Smoke test for the benchmark suite, so it keeps working as the code changes."""
+
+    def test_run_and_compare(self, tmp_path):
+        sys.path.insert(0, _test_dir)
+        try:
+            import bench_HeightOfTerrain as bench
+        finally:
+            sys.path.remove(_test_dir)
+        saved = HeightOfTerrain_module.TdbData
+        results = bench.run_benchmarks(records=2000, repeat=1, workdir=str(tmp_path))
+        assert HeightOfTerrain_module.TdbData == saved
+        assert {'bounds', 'plan', 'lookup_bicubic', 'gap_fill', 'netcdf_write',
+                'startup_import', 'startup_help'} <= set(results['stages'])
+        assert results['stages']['lookup_nearest']['samples_per_second'] > 0
+        json.dumps(results)
+
+        slower = json.loads(json.dumps(results))
+        for stage in slower['stages'].values():
+            stage['seconds'] = stage['seconds'] * 2 + 1
+        assert bench.compare(results, results) == []
+        assert bench.compare(slower, results) != []
+        assert bench.compare(results, slower) == []
+
+
 class TestEdgeCases:
     """Tests for edge cases and boundary conditions."""
 